@@ -1,11 +1,15 @@
 # agent_to_supabase.py
-# pip install openai==1.* requests pandas python-dateutil
+# pip install openai==1.* requests pandas orjson psycopg2-binary
 
-import os, json, time, math, requests as rq
+import os, sys, io, csv, gzip, json, time, math, asyncio, functools, hashlib, sqlite3, orjson, requests as rq
 import pandas as pd
 from datetime import datetime, timezone
-from dateutil import parser as dtparser
-from typing import List, Dict, Any
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import List, Dict, Any, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 # === ENV VARS (set these in your GitHub Actions secrets) ===
 OPENAI_API_KEY        = os.environ["OPENAI_API_KEY"]
@@ -16,86 +20,148 @@ SUPABASE_SERVICE_ROLE = os.environ["SUPABASE_SERVICE_ROLE"]
 OPENAI_MODEL          = os.getenv("OPENAI_MODEL", "gpt-4o-mini")  # fast & cheap; adjust if you prefer
 MAX_ROWS              = int(os.getenv("MAX_ROWS", "100"))         # cap rows per run
 BATCH_SIZE            = int(os.getenv("BATCH_SIZE", "200"))       # upsert chunk size to Supabase
+UPSERT_WORKERS        = int(os.getenv("UPSERT_WORKERS", "4"))     # concurrent upsert chunks
 TIMEOUT_SECS          = int(os.getenv("TIMEOUT_SECS", "60"))
+SUPABASE_GZIP         = os.getenv("SUPABASE_GZIP", "0") == "1"    # opt-in: gzip REST upsert bodies (verify the gateway accepts them)
+SUPABASE_DB_URL       = os.getenv("SUPABASE_DB_URL")              # direct Postgres URI; enables COPY upsert
+EXCHANGES             = [x.strip() for x in os.getenv("EXCHANGES", "LSE,AIM,XETRA,EPA").split(",") if x.strip()]
+PROMPT_BATCH          = int(os.getenv("PROMPT_BATCH", "8"))       # exchange sub-queries per request; >= len(EXCHANGES) sends one prompt
+PER_EXCHANGE_ROWS     = max(1, math.ceil(MAX_ROWS / len(EXCHANGES)))
+OPENAI_CONCURRENCY    = int(os.getenv("OPENAI_CONCURRENCY", "4"))   # batched prompts in flight at once
+OPENAI_RPM            = int(os.getenv("OPENAI_RPM", "60"))          # requests/minute budget
+OPENAI_TPM            = int(os.getenv("OPENAI_TPM", "200000"))      # est. tokens/minute budget
+OPENAI_MAX_RETRIES    = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+LLM_CACHE             = os.path.expanduser(os.getenv("LLM_CACHE", "~/.cache/ziggo/openai.sqlite"))  # "" disables
 
 # === TABLE NAME IN SUPABASE ===
 TABLE = "intradaybullishstocks"  # must exist with the lower-case schema & PK (tradedatehour, ticker)
 
 # === PROMPT (your exact logic, tuned for JSON output) ===
-PROMPT = f"""
-You are a precise data extractor. Return up to {MAX_ROWS} UK- and Europe-listed stocks priced under £5 per share
-(or local-currency equivalent converted to GBP) that look likely to jump based on fresh, positive catalysts in the past 24–48 hours.
+# Per-row field schema, sent as compact JSON rather than a commented example (fewer input tokens per call)
+SCHEMA = {
+    "tradedatehour": "YYYY-MM-DDTHH:00:00Z, UTC hour snapshot",
+    "ticker": "e.g. ABC.L",
+    "exchange": "sub-query id",
+    "stockname": "full company name",
+    "sector": "GICS/industry, short",
+    "lastgbp": "number, last price in GBP",
+    "gappct": "number, premarket/open gap % (0 if unavailable)",
+    "relvol": "number, today volume / 30d avg (1 if unavailable)",
+    "avgvol30d": "integer shares",
+    "range52wpos": "number, 0=52w low 1=52w high (approx ok)",
+    "atrpct": "number, 14d ATR as % of price (approx ok)",
+    "floatshares": "integer or null",
+    "freefloatpct": "number % or null",
+    "shortinterestpct": "number % or null",
+    "marketcapgbp": "integer GBP (approx ok)",
+    "conviction": "High|Medium|Watchlist",
+    "catalyst": "1–2 sentences on the fresh positive catalyst, with specifics",
+    "sourceurl": "primary source (RNS/regulator/company PR); Reuters/FT only if no primary",
+    "newstimestamp": "YYYY-MM-DDTHH:MM:00Z, UTC time of the news item",
+}
+SCHEMA_JSON = json.dumps(SCHEMA, ensure_ascii=False, separators=(",", ":"))
 
+# Batch prompting: each request carries PROMPT_BATCH exchange-scoped sub-queries under one shared
+# instruction block, so the instructions are paid for once per batch rather than once per exchange.
+def build_prompt(exchanges: List[str]) -> str:
+    subqueries = "\n".join(f'- "{x}": up to {PER_EXCHANGE_ROWS} stocks listed on {x}.' for x in exchanges)
+    shape = ", ".join(f'"{x}": [...]' for x in exchanges)
+    return f"""Answer each sub-query independently: stocks likely to jump on fresh (past 24–48h) positive catalysts.
+{subqueries}
 Hard filters:
-- Last price < £5 (converted from local currency to GBP if needed).
+- Last price < £5 (local currency converted to GBP).
 - Average daily volume ≥ 100,000 shares.
-- Exclude tickers with clearly negative same-day news.
-
-Catalyst focus (any of):
-- Earnings beats or raised guidance.
-- Regulatory approvals (e.g., CE mark, FDA/EMA, licenses).
-- Major contracts / orders / partnerships.
-- M&A (including bids/approvals), divestments that unlock value.
-- Analyst upgrades / price-target hikes.
-- Unusually high volume driven by positive news/rumors.
-
-For each stock, return an object with EXACT lower-case keys, matching this schema:
-[
-  {{
-    "tradedatehour": "YYYY-MM-DDTHH:00:00Z",   // UTC hour snapshot
-    "ticker": "ABC.L",
-    "exchange": "LSE" | "AIM" | "XETRA" | "EPA" | "...",
-    "stockname": "Full company name",
-    "sector": "GICS/industry (short)",
-    "lastgbp": 1.23,                            // last price in GBP
-    "gappct": 9.5,                              // premarket/open gap % (or 0 if not available)
-    "relvol": 2.7,                              // today volume / 30d average (or 1 if unavailable)
-    "avgvol30d": 250000,                        // integer shares
-    "range52wpos": 0.62,                        // 0=52w low, 1=52w high (approx if needed)
-    "atrpct": 4.2,                              // 14d ATR as % of price (approx if needed)
-    "floatshares": 120000000,                   // integer if known (else null)
-    "freefloatpct": 85.0,                       // % if known (else null)
-    "shortinterestpct": 3.1,                    // % if known (else null)
-    "marketcapgbp": 320000000,                  // integer GBP (approx ok)
-    "conviction": "High" | "Medium" | "Watchlist",
-    "catalyst": "1–2 sentences on the fresh, positive catalyst with specifics",
-    "sourceurl": "PRIMARY SOURCE (RNS/regulator/company PR). Use Reuters/FT only if primary not available.",
-    "newstimestamp": "YYYY-MM-DDTHH:MM:00Z"     // UTC time of the news item
-  }}
-]
+- No clearly negative same-day news.
+Catalysts: earnings beat/raised guidance; regulatory approval (CE mark, FDA/EMA, licence); major contract/order/partnership; M&A or value-unlocking divestment; analyst upgrade/PT hike; unusual volume on positive news.
+Sort each array: High conviction first, then gappct desc, relvol desc, newstimestamp desc; ties: smaller floatshares, higher shortinterestpct.
+Fill values per this schema, one object per stock with exactly these lower-case keys: {SCHEMA_JSON}
+Output ONLY the JSON object {{{shape}}} with every sub-query id as a key ([] if none qualify)."""
+
+BATCHES = [EXCHANGES[i:i+PROMPT_BATCH] for i in range(0, len(EXCHANGES), PROMPT_BATCH)]
+PROMPTS = [build_prompt(b) for b in BATCHES]
+
+# Chat payloads are built once here; every call (and every SDK retry of it) reuses the same list
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a precise data extractor. Always output valid JSON."}
+MESSAGES = [[SYSTEM_MESSAGE, {"role": "user", "content": p}] for p in PROMPTS]
+
+# ============== OpenAI client (v1, async) ==============
+from openai import AsyncOpenAI
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=OPENAI_MAX_RETRIES)  # SDK backs off exponentially on 429/5xx
+
+class RateLimiter:
+    """Sliding one-minute window over requests (RPM) and estimated tokens (TPM)."""
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm, self.tpm = rpm, tpm
+        self.sent = []  # (monotonic ts, est tokens)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.sent = [(t, n) for t, n in self.sent if now - t < 60]
+                if not self.sent or (len(self.sent) < self.rpm and sum(n for _, n in self.sent) + tokens <= self.tpm):
+                    self.sent.append((now, tokens))
+                    return
+                await asyncio.sleep(60 - (now - self.sent[0][0]))
 
-Sort as:
-- High conviction first, then by: larger gappct desc, higher relvol desc, newer newstimestamp desc.
-- Break ties by smaller floatshares (if known), then higher shortinterestpct.
-
-Output ONLY valid JSON array (no prose, no markdown).
-If you cannot find any valid stocks under these constraints, output [] (an empty JSON array).
-"""
-
-# ============== OpenAI client (v1) ==============
-from openai import OpenAI
-client = OpenAI(api_key=OPENAI_API_KEY)
-
-def call_model() -> List[Dict[str, Any]]:
-    """Call the model and return a JSON list (possibly empty)."""
-    resp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a precise data extractor. Always output valid JSON."},
-            {"role": "user", "content": PROMPT},
-        ],
-        temperature=0.2,
-    )
-    content = resp.choices[0].message.content.strip()
+# ============== Local response cache ==============
+# Runs within the same UTC hour send identical prompts; reuse the stored completion instead of paying for
+# another call. Keyed by (model, hour, prompt); entries older than a day are pruned on write.
+def _cache_key(prompt: str) -> str:
+    hour = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H")
+    return hashlib.sha256(f"{OPENAI_MODEL}\0{hour}\0{prompt}".encode()).hexdigest()
+
+def _cache_db() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(LLM_CACHE) or ".", exist_ok=True)
+    db = sqlite3.connect(LLM_CACHE)
+    db.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, content TEXT, ts INTEGER)")
+    return db
+
+def cache_get(key: str) -> Optional[str]:
+    if not LLM_CACHE:
+        return None
+    with closing(_cache_db()) as db:
+        hit = db.execute("SELECT content FROM llm_cache WHERE key = ?", (key,)).fetchone()
+    return hit[0] if hit else None
+
+def cache_put(key: str, content: str):
+    if not LLM_CACHE:
+        return
+    now = int(time.time())
+    with closing(_cache_db()) as db, db:
+        db.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)", (key, content, now))
+        db.execute("DELETE FROM llm_cache WHERE ts < ?", (now - 86400,))
+
+async def call_model_batch(messages: List[Dict[str, str]], limiter: RateLimiter) -> List[Dict[str, Any]]:
+    """Call the model with one batched prompt and flatten the per-exchange arrays into one list."""
+    prompt = messages[-1]["content"]
+    key = _cache_key(prompt)
+    content = cache_get(key)
+    if content is None:
+        await limiter.acquire(len(prompt) // 4)  # rough estimate: ~4 chars per token
+        resp = await client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            temperature=0.2,
+            response_format={"type": "json_object"},  # JSON mode: no prose/markdown to strip
+        )
+        content = resp.choices[0].message.content
     try:
-        data = json.loads(content)
-        if isinstance(data, dict) and "data" in data:
-            data = data["data"]
-        if not isinstance(data, list):
-            raise ValueError("Model returned a non-list JSON structure.")
-        return data[:MAX_ROWS]
+        data = orjson.loads(content)
+        if not isinstance(data, dict):
+            raise ValueError("Model returned a non-object JSON structure.")
+        rows = []
+        for exchange, items in data.items():
+            if not isinstance(items, list):
+                raise ValueError(f"Model returned a non-list value for sub-query {exchange!r}.")
+            if not all(isinstance(r, dict) for r in items):
+                raise ValueError(f"Model returned non-object rows for sub-query {exchange!r}.")
+            rows.extend(items)
     except Exception as e:
         raise RuntimeError(f"Model did not return valid JSON. Error: {e}\nReturned: {content[:1200]}")
+    cache_put(key, content)  # only cache completions with the expected {id: [row objects]} shape
+    return rows
 
 # ============== Normalization / Validation ==============
 REQUIRED = [
@@ -103,112 +169,226 @@ REQUIRED = [
     "avgvol30d","range52wpos","atrpct","floatshares","freefloatpct","shortinterestpct",
     "marketcapgbp","conviction","catalyst","sourceurl","newstimestamp"
 ]
+NUMERIC_COLS = ["lastgbp","gappct","relvol","avgvol30d","range52wpos","atrpct",
+                "floatshares","freefloatpct","shortinterestpct","marketcapgbp"]
+INT_COLS = ["avgvol30d","floatshares","marketcapgbp"]  # bigint in the table; rounded half-to-even
+INT_LIMIT = 2**63  # bigint range; larger magnitudes are nonsense and normalize to null
+ESSENTIAL = ["tradedatehour","ticker","stockname","sourceurl"]
+PANDAS_MIN_ROWS = 500  # above this many rows the vectorized pandas path wins
 
-def normalize_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    if not rows:
-        return []
-    df = pd.DataFrame(rows)
+def _normalize_rows_pandas(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    src = pd.DataFrame(rows)
     # Lower-case columns to match DB schema exactly
-    df.columns = [c.lower() for c in df.columns]
-    # Ensure all required cols exist
-    for c in REQUIRED:
-        if c not in df.columns:
-            df[c] = None
-    # Coerce date-times
-    def to_iso_hour(ts):
-        if pd.isna(ts): return None
-        try:
-            dt = dtparser.parse(str(ts))
-            dt = dt.astimezone(timezone.utc)
-            # floor to hour for tradedatehour
-            return dt.replace(minute=0, second=0, microsecond=0).isoformat().replace("+00:00","Z")
-        except Exception:
-            return None
-
-    def to_iso(ts):
-        if pd.isna(ts): return None
-        try:
-            dt = dtparser.parse(str(ts)).astimezone(timezone.utc)
-            return dt.isoformat().replace("+00:00","Z")
-        except Exception:
-            return None
+    src.columns = [c.lower() for c in src.columns]
+    # Missing required cols read as all-null
+    missing = pd.Series(None, index=src.index, dtype=object)
+    cols = {c: src[c] if c in src.columns else missing for c in REQUIRED}
 
-    # tradedatehour: if missing, use current hour UTC
-    if "tradedatehour" in df:
-        df["tradedatehour"] = df["tradedatehour"].apply(lambda x: to_iso_hour(x) or to_iso_hour(datetime.utcnow()))
-    else:
-        df["tradedatehour"] = to_iso_hour(datetime.utcnow())
+    # Coerce date-times in one vectorized pass; an explicit ISO8601 format skips per-row format inference
+    tdh = pd.to_datetime(cols["tradedatehour"], utc=True, errors="coerce", format="ISO8601")
+    # tradedatehour: if missing/unparseable, use current hour UTC
+    tdh = tdh.fillna(pd.Timestamp(datetime.now(timezone.utc)))
+    cols["tradedatehour"] = tdh.dt.floor("h").dt.strftime("%Y-%m-%dT%H:00:00Z")
 
     # newstimestamp
-    df["newstimestamp"] = df["newstimestamp"].apply(to_iso)
-
-    # Coerce numerics safely
-    numeric_cols = ["lastgbp","gappct","relvol","avgvol30d","range52wpos","atrpct",
-                    "floatshares","freefloatpct","shortinterestpct","marketcapgbp"]
-    for col in numeric_cols:
-        def to_num(x):
-            try:
-                if x is None or (isinstance(x, str) and x.strip() == ""): return None
-                return float(x)
-            except Exception:
-                return None
-        df[col] = df[col].apply(to_num)
+    nts = pd.to_datetime(cols["newstimestamp"], utc=True, errors="coerce", format="ISO8601")
+    cols["newstimestamp"] = nts.dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    # Coerce numerics safely (vectorized; blanks/garbage/inf -> NaN)
+    for col in NUMERIC_COLS:
+        num = pd.to_numeric(cols[col], errors="coerce")
+        cols[col] = num.where(num.abs() != float("inf"))
+    # Build the frame once, already in REQUIRED order, instead of growing it column by column
+    df = pd.DataFrame(cols, copy=False)
+    # Convert numerics to int where appropriate: one nullable cast over all int columns; values outside
+    # bigint range go NA first (the cast would silently wrap them, e.g. 1e30 -> a negative market cap)
+    ints = df[INT_COLS].astype("Float64").round()
+    df[INT_COLS] = ints.where(ints.abs() < INT_LIMIT).astype("Int64")
 
     # Minimal sanity: drop rows missing essentials
-    df = df.dropna(subset=["tradedatehour","ticker","stockname","sourceurl"], how="any")
+    df = df.dropna(subset=ESSENTIAL, how="any")
+
+    # NaN/NA -> None so the JSON payload stays valid
+    df = df.astype(object)
+    return df.where(df.notna(), None).to_dict(orient="records")
+
+# Small batches (the usual hourly run) skip pandas: building and tearing down a DataFrame costs more than
+# a plain loop over a few dozen dicts. Parsing rules match the pandas path: ISO 8601 timestamps only
+# (naive = UTC), non-finite numbers -> null.
+def _to_iso(ts, fmt: str):
+    if ts is None: return None
+    try:
+        dt = ts if isinstance(ts, datetime) else datetime.fromisoformat(str(ts))
+        dt = dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+        return dt.strftime(fmt)
+    except Exception:
+        return None
+
+def _to_num(x):
+    try:
+        if x is None or (isinstance(x, str) and x.strip() == ""): return None
+        v = float(x)
+        return v if math.isfinite(v) else None
+    except Exception:
+        return None
 
-    # Keep only required columns in order
-    df = df[REQUIRED]
-    # Convert numerics to int where appropriate
-    for col in ["avgvol30d","floatshares","marketcapgbp"]:
-        df[col] = df[col].apply(lambda v: int(v) if pd.notna(v) and float(v).is_integer() else (int(v) if pd.notna(v) else None))
+def _normalize_row(d: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+    d = {k.lower(): v for k, v in d.items()}
+    row = {c: d.get(c) for c in REQUIRED}
+    # tradedatehour: if missing/unparseable, use current hour UTC
+    row["tradedatehour"] = _to_iso(row["tradedatehour"], "%Y-%m-%dT%H:00:00Z") or now.strftime("%Y-%m-%dT%H:00:00Z")
+    row["newstimestamp"] = _to_iso(row["newstimestamp"], "%Y-%m-%dT%H:%M:%SZ")
+    for col in NUMERIC_COLS:
+        row[col] = _to_num(row[col])
+    for col in INT_COLS:
+        if row[col] is not None:
+            v = round(row[col])
+            row[col] = v if abs(v) < INT_LIMIT else None
+    return row
 
-    return df.to_dict(orient="records")
+def normalize_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    if not rows:
+        return []
+    if len(rows) > PANDAS_MIN_ROWS:
+        return _normalize_rows_pandas(rows)
+    now = datetime.now(timezone.utc)
+    # Minimal sanity: drop rows missing essentials
+    return [r for r in (_normalize_row(d, now) for d in rows) if all(r[c] is not None for c in ESSENTIAL)]
 
 # ============== Supabase upsert ==============
+# One pooled keep-alive session shared by every upsert worker; the adapter retries transient failures with exponential
+# backoff. POST is retried too: merge-duplicates upserts are idempotent.
+SESSION = rq.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=UPSERT_WORKERS, max_retries=Retry(
+    total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=frozenset({"POST"}), raise_on_status=False,
+)))
+
+def _json_default(o):
+    if isinstance(o, Decimal):
+        return float(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+UPSERT_URL = f"{SUPABASE_PROJECT_URL}/rest/v1/{TABLE}"
+UPSERT_HEADERS = {
+    "apikey": SUPABASE_SERVICE_ROLE,
+    "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE}",
+    "Content-Type": "application/json",
+    "Prefer": "resolution=merge-duplicates",
+    **({"Content-Encoding": "gzip"} if SUPABASE_GZIP else {}),  # repeated keys compress ~5-8x
+}
+
+def _post_chunk(chunk: List[Dict[str, Any]]) -> int:
+    body = orjson.dumps(chunk, default=_json_default, option=orjson.OPT_UTC_Z | orjson.OPT_SERIALIZE_NUMPY)
+    if SUPABASE_GZIP:
+        body = gzip.compress(body, compresslevel=6)
+    r = SESSION.post(UPSERT_URL, headers=UPSERT_HEADERS, data=body, timeout=TIMEOUT_SECS)
+    if r.status_code not in (200, 201, 204):
+        raise RuntimeError(f"Supabase upsert failed: {r.status_code} {r.text[:500]}")
+    return len(chunk)
+
 def supabase_upsert(rows: List[Dict[str, Any]]) -> int:
     if not rows:
         return 0
+    # Chunks cover disjoint PKs, so they can be posted concurrently (I/O bound, threads are fine)
+    chunks = [rows[i:i+BATCH_SIZE] for i in range(0, len(rows), BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=UPSERT_WORKERS) as ex:
+        return sum(ex.map(_post_chunk, chunks))
+
+# ============== Direct Postgres upsert (optional) ==============
+# With a direct connection, stream every row into a temp stage with one COPY and merge with a single
+# INSERT ... ON CONFLICT, instead of one PostgREST round trip per chunk (same approach as etl.py).
+def pg_connect():
+    import psycopg2  # only needed when SUPABASE_DB_URL is set
+    return psycopg2.connect(SUPABASE_DB_URL)
 
-    url = f"{SUPABASE_PROJECT_URL}/rest/v1/{TABLE}"
-    headers = {
-        "apikey": SUPABASE_SERVICE_ROLE,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE}",
-        "Content-Type": "application/json",
-        "Prefer": "resolution=merge-duplicates"
-    }
-
-    total = 0
-    for i in range(0, len(rows), BATCH_SIZE):
-        chunk = rows[i:i+BATCH_SIZE]
-        # Retry a couple of times on transient errors
-        for attempt in range(3):
-            try:
-                r = rq.post(url, headers=headers, json=chunk, timeout=TIMEOUT_SECS)
-                if r.status_code in (200, 201, 204):
-                    total += len(chunk)
-                    break
-                else:
-                    raise RuntimeError(f"Supabase upsert failed: {r.status_code} {r.text[:500]}")
-            except Exception as e:
-                if attempt < 2:
-                    time.sleep(2 ** attempt)
-                    continue
-                raise
-    return total
+def supabase_upsert_via_copy(rows: List[Dict[str, Any]], conn=None) -> int:
+    """Upsert rows in one transaction on `conn` (reused across batches), or on a fresh connection if None."""
+    if not rows:
+        return 0
+
+    # Explicit \N marker for NULL, so empty strings survive COPY as "" (csv.writer writes both as an empty field)
+    buf = io.StringIO()
+    csv.writer(buf).writerows([r"\N" if r[c] is None else r[c] for c in REQUIRED] for r in rows)
+    buf.seek(0)
+
+    cols = ", ".join(REQUIRED)
+    updates = ",\n          ".join(f"{c} = EXCLUDED.{c}" for c in REQUIRED if c not in ("tradedatehour", "ticker"))
+    own = conn is None
+    if own:
+        conn = pg_connect()
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute(f"CREATE TEMP TABLE _stage (LIKE public.{TABLE} INCLUDING DEFAULTS) ON COMMIT DROP;")
+            cur.copy_expert(f"COPY _stage ({cols}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buf)
+            # DISTINCT ON: a PK repeated within one run would otherwise abort the whole ON CONFLICT statement
+            cur.execute(f"""
+            INSERT INTO public.{TABLE} AS t ({cols})
+            SELECT DISTINCT ON (tradedatehour, ticker) {cols}
+            FROM _stage
+            ON CONFLICT (tradedatehour, ticker) DO UPDATE SET
+              {updates};
+            """)
+            return cur.rowcount
+    finally:
+        if own:
+            conn.close()
 
 # ============== MAIN ==============
+async def run_pipeline() -> Dict[str, Any]:
+    """Overlap model calls with upserts: each batch is normalized and queued for upsert as soon as it lands.
+
+    A failed model batch is logged and recorded in stats["failed"]; the other batches still run and upsert.
+    """
+    limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM)
+    sem = asyncio.Semaphore(OPENAI_CONCURRENCY)
+    queue: asyncio.Queue = asyncio.Queue()
+    stats = {"received": 0, "normalized": 0, "upserted": 0, "failed": []}
+    # one COPY + merge per batch over a single direct connection if configured, else REST
+    db = pg_connect() if SUPABASE_DB_URL else None
+    upsert = functools.partial(supabase_upsert_via_copy, conn=db) if db else supabase_upsert
+
+    async def produce(exchanges, messages):
+        try:
+            async with sem:
+                batch = await call_model_batch(messages, limiter)  # 1) get rows from the model (JSON)
+            batch = batch[:MAX_ROWS - stats["received"]]           # overall MAX_ROWS cap
+            rows = normalize_rows(batch)                           # 2) normalize/validate to DB schema
+        except Exception as e:
+            print(f"Model batch {','.join(exchanges)} failed: {e}", file=sys.stderr)
+            stats["failed"].append(",".join(exchanges))
+            return
+        stats["received"] += len(batch)
+        stats["normalized"] += len(rows)
+        if rows:
+            await queue.put(rows)
+
+    async def consume():
+        while (rows := await queue.get()) is not None:
+            stats["upserted"] += await asyncio.to_thread(upsert, rows)  # 3) upsert (blocking I/O off-loop)
+
+    consumer = asyncio.create_task(consume())
+    try:
+        # Producers never raise: model and normalization failures are recorded above, so every good batch
+        # still gets queued
+        await asyncio.gather(*(produce(b, m) for b, m in zip(BATCHES, MESSAGES)))
+        await queue.put(None)  # sentinel: let the consumer drain what it has, then stop
+        await consumer         # re-raises an upsert failure
+    finally:
+        consumer.cancel()      # no-op if it finished; stops it if we are unwinding from an error
+        if db:
+            db.close()
+    return stats
+
 def main():
-    model_rows = call_model()                 # 1) get rows from the model (JSON)
-    rows = normalize_rows(model_rows)         # 2) normalize/validate to DB schema
-    upserted = supabase_upsert(rows)          # 3) upsert directly into Supabase REST
+    stats = asyncio.run(run_pipeline())
     print(json.dumps({
         "timestamp_utc": datetime.utcnow().isoformat() + "Z",
         "model": OPENAI_MODEL,
-        "received": len(model_rows),
-        "normalized": len(rows),
-        "upserted": upserted
+        **stats,
     }, indent=2))
+    if stats["failed"]:
+        raise RuntimeError(f"{len(stats['failed'])} of {len(BATCHES)} model batches failed: {stats['failed']}")
 
 if __name__ == "__main__":
     main()
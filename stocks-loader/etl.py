@@ -1,8 +1,9 @@
 # etl.py — JSON → Postgres (no files), lower-case columns to match Postgres
-# pip install: pandas requests sqlalchemy psycopg2-binary
+# pip install: pandas requests "sqlalchemy>=2" psycopg2-binary orjson ijson
 
-import os, pandas as pd, requests as rq
+import os, io, itertools, orjson, pandas as pd, requests as rq
 from sqlalchemy import create_engine, text
+from psycopg2.extras import execute_values
 
 PG_HOST=os.environ["PG_HOST"]
 PG_PORT=os.environ.get("PG_PORT","5432")
@@ -11,6 +12,10 @@ PG_USER=os.environ["PG_USER"]
 PG_PASSWORD=os.environ["PG_PASSWORD"]
 
 DATA_API=os.environ["DATA_API"]   # HTTPS endpoint returning JSON array
+# Stream-parse responses whose Content-Length exceeds this. The check only sees the header: chunked
+# responses (no Content-Length) are always loaded in full, and for gzip-encoded responses it is the
+# compressed size, so the decoded payload can be several times larger than the threshold.
+STREAM_MIN_BYTES=int(os.environ.get("STREAM_MIN_BYTES", str(50 * 1024 * 1024)))
 
 REQUIRED_COLS = [
   "tradedatehour","ticker","exchange","stockname","sector","lastgbp","gappct",
@@ -18,35 +23,87 @@ REQUIRED_COLS = [
   "shortinterestpct","marketcapgbp","conviction","catalyst","sourceurl","newstimestamp"
 ]
 
+NUMERIC_DTYPES = {
+  "lastgbp":"float64","gappct":"float64","relvol":"float64","avgvol30d":"Int64",
+  "range52wpos":"float64","atrpct":"float64","floatshares":"Int64","freefloatpct":"float64",
+  "shortinterestpct":"float64","marketcapgbp":"Int64"
+}
+
+STATEMENT_TIMEOUT_MS=int(os.environ.get("STATEMENT_TIMEOUT_MS","30000"))
+STAGE_MIN_ROWS=int(os.environ.get("STAGE_MIN_ROWS","500"))  # below this, skip the temp stage
+
+INSERT_COLS = """
+  tradedatehour, ticker, exchange, stockname, sector, lastgbp, gappct, relvol,
+  avgvol30d, range52wpos, atrpct, floatshares, freefloatpct, shortinterestpct,
+  marketcapgbp, conviction, catalyst, sourceurl, newstimestamp
+"""
+
+ON_CONFLICT = """
+ON CONFLICT (tradedatehour, ticker) DO UPDATE SET
+  exchange = EXCLUDED.exchange,
+  stockname = EXCLUDED.stockname,
+  sector = EXCLUDED.sector,
+  lastgbp = EXCLUDED.lastgbp,
+  gappct = EXCLUDED.gappct,
+  relvol = EXCLUDED.relvol,
+  avgvol30d = EXCLUDED.avgvol30d,
+  range52wpos = EXCLUDED.range52wpos,
+  atrpct = EXCLUDED.atrpct,
+  floatshares = EXCLUDED.floatshares,
+  freefloatpct = EXCLUDED.freefloatpct,
+  shortinterestpct = EXCLUDED.shortinterestpct,
+  marketcapgbp = EXCLUDED.marketcapgbp,
+  conviction = EXCLUDED.conviction,
+  catalyst = EXCLUDED.catalyst,
+  sourceurl = EXCLUDED.sourceurl,
+  newstimestamp = EXCLUDED.newstimestamp
+"""
+
 def fetch_json():
-    r = rq.get(DATA_API, timeout=60)
+    r = rq.get(DATA_API, timeout=60, stream=True)
     r.raise_for_status()
-    data = r.json()
+    if int(r.headers.get("Content-Length") or 0) > STREAM_MIN_BYTES:
+        # Huge payloads: yield rows while parsing instead of holding the body and its parsed copy at once
+        import ijson
+        r.raw.decode_content = True
+        events = ijson.parse(r.raw, use_float=True)
+        first = next(events, None)
+        if first is None or first[1] != "start_array":
+            raise ValueError("DATA_API must return a JSON array of row objects.")
+        return ijson.items(itertools.chain([first], events), "item")
+    data = orjson.loads(r.content)
     if not isinstance(data, list):
         raise ValueError("DATA_API must return a JSON array of row objects.")
     return data
 
 def normalize(rows):
-    # Build DF and force lower-case column names to match Postgres
-    df = pd.DataFrame(rows)
-    df.columns = [c.lower() for c in df.columns]
-
-    # Ensure all required columns exist
-    for c in REQUIRED_COLS:
-        if c not in df.columns:
-            df[c] = None
+    # Lower-case keys to match Postgres, then build the DF once with exactly the required columns
+    rows = ({k.lower(): v for k, v in r.items()} for r in rows)
+    df = pd.DataFrame.from_records(rows, columns=REQUIRED_COLS)
 
     # Coerce datetimes
     df["tradedatehour"] = pd.to_datetime(df["tradedatehour"], utc=True, errors="coerce")
-    if "newstimestamp" in df.columns:
-        df["newstimestamp"] = pd.to_datetime(df["newstimestamp"], utc=True, errors="coerce")
+    df["newstimestamp"] = pd.to_datetime(df["newstimestamp"], utc=True, errors="coerce")
 
-    # Reorder
-    return df[REQUIRED_COLS]
+    # Coerce numerics and cast to their column dtypes in one pass; bigint columns become nullable ints,
+    # so COPY gets "250000" rather than "250000.0"
+    bigint = [c for c, t in NUMERIC_DTYPES.items() if t == "Int64"]
+    df[list(NUMERIC_DTYPES)] = (
+        df[list(NUMERIC_DTYPES)].apply(pd.to_numeric, errors="coerce")
+        .round(dict.fromkeys(bigint, 0))
+        .astype(NUMERIC_DTYPES)
+    )
+    return df
 
 def engine():
     uri = f"postgresql+psycopg2://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_DATABASE}"
-    return create_engine(uri, pool_pre_ping=True, pool_recycle=300)
+    return create_engine(
+        uri,
+        pool_size=5, max_overflow=10, pool_pre_ping=True, pool_recycle=300,
+        # psycopg2 fast executemany: multi-row VALUES for INSERTs, execute_batch for the rest
+        executemany_mode="values_plus_batch", insertmanyvalues_page_size=1000,
+        connect_args={"options": f"-c statement_timeout={STATEMENT_TIMEOUT_MS}"},  # cap runaway statements
+    )
 
 def upsert(df, eng):
     ddl = """
@@ -77,43 +134,33 @@ def upsert(df, eng):
         # 1) Ensure table exists
         conn.exec_driver_sql(ddl)
 
-        # 2) Temp stage table has the SAME (lower-case) columns
-        conn.exec_driver_sql("CREATE TEMP TABLE _stage (LIKE public.bullishstocks INCLUDING ALL);")
-
-        # 3) Insert DataFrame (columns are lower-case, so pandas quotes "tradedatehour" etc. exactly)
-        df.to_sql("_stage", conn, if_exists="append", index=False)
-
-        # 4) Merge into target
-        conn.execute(text("""
-        INSERT INTO public.bullishstocks AS t (
-          tradedatehour, ticker, exchange, stockname, sector, lastgbp, gappct, relvol,
-          avgvol30d, range52wpos, atrpct, floatshares, freefloatpct, shortinterestpct,
-          marketcapgbp, conviction, catalyst, sourceurl, newstimestamp
-        )
-        SELECT
-          tradedatehour, ticker, exchange, stockname, sector, lastgbp, gappct, relvol,
-          avgvol30d, range52wpos, atrpct, floatshares, freefloatpct, shortinterestpct,
-          marketcapgbp, conviction, catalyst, sourceurl, newstimestamp
-        FROM _stage
-        ON CONFLICT (tradedatehour, ticker) DO UPDATE SET
-          exchange = EXCLUDED.exchange,
-          stockname = EXCLUDED.stockname,
-          sector = EXCLUDED.sector,
-          lastgbp = EXCLUDED.lastgbp,
-          gappct = EXCLUDED.gappct,
-          relvol = EXCLUDED.relvol,
-          avgvol30d = EXCLUDED.avgvol30d,
-          range52wpos = EXCLUDED.range52wpos,
-          atrpct = EXCLUDED.atrpct,
-          floatshares = EXCLUDED.floatshares,
-          freefloatpct = EXCLUDED.freefloatpct,
-          shortinterestpct = EXCLUDED.shortinterestpct,
-          marketcapgbp = EXCLUDED.marketcapgbp,
-          conviction = EXCLUDED.conviction,
-          catalyst = EXCLUDED.catalyst,
-          sourceurl = EXCLUDED.sourceurl,
-          newstimestamp = EXCLUDED.newstimestamp;
-        """))
+        if len(df) < STAGE_MIN_ROWS:
+            # 2) Small loads: one multi-row INSERT ... ON CONFLICT straight into the target, no temp stage
+            rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+            execute_values(
+                conn.connection.cursor(),
+                f"INSERT INTO public.bullishstocks AS t ({INSERT_COLS}) VALUES %s {ON_CONFLICT}",
+                rows, page_size=200,
+            )
+        else:
+            # 2) Temp stage table has the SAME (lower-case) columns
+            conn.exec_driver_sql("CREATE TEMP TABLE _stage (LIKE public.bullishstocks INCLUDING ALL);")
+
+            # 3) Stream DataFrame in with one COPY; explicit \N marks NULL, so "" stays an empty string
+            buf = io.StringIO()
+            df.to_csv(buf, index=False, header=False, na_rep=r"\N")
+            buf.seek(0)
+            conn.connection.cursor().copy_expert(
+                f"COPY _stage ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buf
+            )
+
+            # 4) Merge into target
+            conn.execute(text(f"""
+            INSERT INTO public.bullishstocks AS t ({INSERT_COLS})
+            SELECT {INSERT_COLS}
+            FROM _stage
+            {ON_CONFLICT}
+            """))
     print(f"Upserted {len(df)} rows.")
 
 if __name__ == "__main__":